@@ -2,8 +2,9 @@
 # Speed test logic from https://github.com/PhasecoreX/PCXCogs/tree/master/netspeed
 
 import asyncio
-import concurrent
+import concurrent.futures
 import datetime
+import logging
 import time
 
 import discord
@@ -12,12 +13,40 @@ from redbot.core import checks, commands
 
 old_ping = None
 
+log = logging.getLogger("red.customping")
+
+# How long, in seconds, a host latency lookup is reused for.
+HOST_PING_TTL = 30
+# How long, in seconds, a host latency lookup may take before it is given up on.
+HOST_PING_TIMEOUT = 30
+
+
+def best_server_ping():
+    """Find the closest speedtest.net server and return its ping, this blocks so run it in an executor."""
+    s = speedtest.Speedtest(secure=True)
+    s.get_servers()
+    s.get_best_server()
+    return round(s.results.dict()["ping"], 2)
+
+
+def latency_color(latency):
+    """Pick the embed colour for an average latency in milliseconds."""
+    if latency >= 1000:
+        return discord.Colour.red()
+    elif latency >= 200:
+        return discord.Colour.orange()
+    return discord.Colour.green()
+
 
 class CustomPing(commands.Cog):
     """A more information rich ping message."""
 
     def __init__(self, bot):
         self.bot = bot
+        self._host_ping_cache = None  # (time.monotonic() of lookup, ping or None if it failed)
+        self._host_ping_future = None  # the lookup in progress, shared by every ping waiting on it
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._stalled_lookup = None  # a timed out lookup that may still be running on the executor
 
     async def red_delete_data_for_user(self, **kwargs):
         return
@@ -30,6 +59,10 @@ class CustomPing(commands.Cog):
             except:
                 pass
             self.bot.add_command(old_ping)
+        if self._host_ping_future is not None:
+            self._host_ping_future.cancel()
+        # Don't block the unload on a lookup that is still running, its thread exits once it's done.
+        self._executor.shutdown(wait=False)
 
     @checks.bot_has_permissions(embed_links=True)
     @commands.cooldown(2, 5, commands.BucketType.user)
@@ -40,56 +73,110 @@ class CustomPing(commands.Cog):
         message = await ctx.send("Pinging...")
         end = time.monotonic()
         totalPing = round((end - start) * 1000, 2)
-        e = discord.Embed(title="Pinging.. :calling:", description=f"Overall Latency: {totalPing}ms")
-        await asyncio.sleep(0.25)
-        try:
-            await message.edit(content=None, embed=e)
-        except discord.NotFound:
-            return
-
-        botPing = round(self.bot.latency * 1000, 2)
-        e.description = e.description + f"\nDiscord WebSocket Latency: {botPing}ms"
-        await asyncio.sleep(0.25)
-
-        averagePing = (botPing + totalPing) / 2
-        if averagePing >= 1000:
-            color = discord.Colour.red()
-        elif averagePing >= 200:
-            color = discord.Colour.orange()
-        else:
-            color = discord.Colour.green()
-
-        e.color = color
-        try:
-            await message.edit(embed=e)
-        except discord.NotFound:
-            return
 
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-        loop = asyncio.get_event_loop()
+        # Look up the host latency while the other results are being shown.
+        host_task = asyncio.ensure_future(self._get_host_ping())
         try:
-            s = speedtest.Speedtest(secure=True)
-            await loop.run_in_executor(executor, s.get_servers)
-            await loop.run_in_executor(executor, s.get_best_server)
-        except speedtest.ConfigRetrievalError:
-            return
-        else:
-            result = s.results.dict()
-            hostPing = round(result["ping"], 2)
+            # The WebSocket latency is already known, so it goes out with the first edit.
+            botPing = round(self.bot.latency * 1000, 2)
+            averagePing = (botPing + totalPing) / 2
+            e = discord.Embed(
+                title="Pinging.. :calling:",
+                description=f"Overall Latency: {totalPing}ms\nDiscord WebSocket Latency: {botPing}ms",
+                color=latency_color(averagePing),
+            )
+            await asyncio.sleep(0.25)
+            # A cached lookup has usually finished by now, then everything goes out in a single edit.
+            if not host_task.done():
+                try:
+                    await message.edit(content=None, embed=e)
+                except discord.NotFound:
+                    return
+                measured_at, hostPing = await host_task
+                await asyncio.sleep(0.25)
+            else:
+                measured_at, hostPing = host_task.result()
 
             e.title = "Pong! :satellite_orbital:"
-            e.description = e.description + f"\nHost Latency: {hostPing}ms"
-            await asyncio.sleep(0.25)
+            if hostPing is None:
+                e.description = e.description + "\nHost Latency: unavailable"
+            else:
+                e.description = e.description + f"\nHost Latency: {hostPing}ms"
+                # Say so when a cached measurement is being reused.
+                age = round(time.monotonic() - measured_at)
+                if age:
+                    e.description = e.description + f" (measured {age}s ago)"
             try:
-                await message.edit(embed=e)
+                await message.edit(content=None, embed=e)
             except discord.NotFound:
                 return
+        finally:
+            host_task.cancel()
+
+    async def _get_host_ping(self):
+        """Ping the closest speedtest.net server.
+
+        Returns a (time.monotonic() it was measured at, ping) pair, ping is None if it could not be reached.
+        """
+        if self._host_ping_cache is not None and time.monotonic() - self._host_ping_cache[0] < HOST_PING_TTL:
+            return self._host_ping_cache
+
+        # Concurrent pings share one lookup, shielded so it still fills the cache when a ping stops waiting.
+        if self._host_ping_future is None:
+            self._host_ping_future = asyncio.ensure_future(self._lookup_host_ping())
+        future = self._host_ping_future
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The lookup itself is only cancelled when the cog unloads, finish the ping without it.
+            if future.cancelled():
+                return time.monotonic(), None
+            raise
+
+    async def _lookup_host_ping(self):
+        if self._stalled_lookup is not None and not self._stalled_lookup.done():
+            # The only worker is still stuck on a timed out lookup, queueing behind it could take forever.
+            self._host_ping_future = None
+            return time.monotonic(), None
+
+        try:
+            lookup = self._executor.submit(best_server_ping)
+        except RuntimeError:
+            # The executor has been shut down by cog_unload.
+            self._host_ping_future = None
+            return time.monotonic(), None
+        try:
+            hostPing = await asyncio.wait_for(asyncio.wrap_future(lookup), timeout=HOST_PING_TIMEOUT)
+        except speedtest.SpeedtestException as exc:
+            # Remember the failure as well so an unreachable speedtest.net isn't retried on every ping.
+            log.warning("Host latency lookup failed, skipping it for %s seconds: %s", HOST_PING_TTL, exc)
+            hostPing = None
+        except asyncio.TimeoutError:
+            log.warning(
+                "Host latency lookup took longer than %s seconds, skipping it.", HOST_PING_TIMEOUT
+            )
+            self._stalled_lookup = lookup
+            hostPing = None
+        except Exception:
+            # Every ping may have stopped waiting already, so nobody else would see this error.
+            log.exception("Host latency lookup failed.")
+            hostPing = None
+        except asyncio.CancelledError:
+            # Cancelled by cog_unload, make sure the speedtest never runs if it's still queued.
+            lookup.cancel()
+            raise
+        finally:
+            self._host_ping_future = None
+        self._host_ping_cache = (time.monotonic(), hostPing)
+        return self._host_ping_cache
 
     @ping.command()
     async def moreinfo(self, ctx: commands.Context):
         """Ping with additional latency stastics."""
-        now = datetime.datetime.utcnow().timestamp()
-        receival_ping = round((now - ctx.message.created_at.timestamp()) * 1000, 2)
+        # created_at is naive UTC on older discord.py, make it aware so it's never read as local time.
+        created_at = ctx.message.created_at.replace(tzinfo=datetime.timezone.utc)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        receival_ping = round((now - created_at).total_seconds() * 1000, 2)
 
         e = discord.Embed(
             title="Pinging.. :calling:",
@@ -113,14 +200,7 @@ class CustomPing(commands.Cog):
         e.description += f"\nEdit Latency: {edit_ping}ms"
 
         average_ping = (receival_ping + send_ping + edit_ping) / 3
-        if average_ping >= 1000:
-            color = discord.Colour.red()
-        elif average_ping >= 200:
-            color = discord.Colour.orange()
-        else:
-            color = discord.Colour.green()
-
-        e.color = color
+        e.color = latency_color(average_ping)
         e.title = "Pong! :satellite_orbital:"
 
         await asyncio.sleep(0.25)
@@ -139,12 +219,7 @@ class CustomPing(commands.Cog):
             latencies.append(latency)
             description.append(f"#{shard_id}: {latency}ms")
         average_ping = sum(latencies) / len(latencies)
-        if average_ping >= 1000:
-            color = discord.Colour.red()
-        elif average_ping >= 200:
-            color = discord.Colour.orange()
-        else:
-            color = discord.Colour.green()
+        color = latency_color(average_ping)
         e = discord.Embed(color=color, title="Shard Pings :file_cabinet:", description="\n".join(description))
         e.set_footer(text=f"Average: {average_ping}ms")
         await ctx.send(embed=e)